@@ -3,17 +3,32 @@ from datetime import datetime, date, time
 from dotenv import load_dotenv
 import os
 from pymongo import MongoClient
-import csv
+import bson
+import gzip
 import io
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, List, Optional
 
 load_dotenv()
 
+# Number of timestamp sub-ranges fetched concurrently during an export;
+# must stay below the client's maxPoolSize
+EXPORT_WORKERS = 4
+
+# Raw batches each worker may hold ahead of the consumer; with ~16MB batches
+# peak export memory stays near EXPORT_WORKERS * (EXPORT_PREFETCH_BATCHES + 1) * 16MB
+EXPORT_PREFETCH_BATCHES = 2
+
+# Server-side time budget for each export cursor
+EXPORT_MAX_TIME_MS = 60_000
+
 # Initialize MongoDB connection with optimizations
 @st.cache_resource
 def get_mongo_client():
-    """Cache MongoDB client to avoid reconnection overhead"""
+    """Cache MongoDB client to avoid reconnection overhead (one pool shared by every session)"""
     mongo_uri = os.getenv("MONGO_URL")
     # Add connection pooling and timeout optimizations
     client = MongoClient(
@@ -23,16 +38,26 @@ def get_mongo_client():
         socketTimeoutMS=30000,  # 30 second socket timeout
         connectTimeoutMS=5000,  # 5 second connection timeout
         maxIdleTimeMS=45000,  # Keep connections alive longer
-        waitQueueTimeoutMS=5000
+        waitQueueTimeoutMS=5000,
+        readPreference="nearest",  # Lowest-latency member serves the export
+        readConcernLevel="local",
+        compressors="zstd,snappy,zlib",  # Compress wire traffic; first one the server supports wins
+        zlibCompressionLevel=1
     )
     return client
 
+# Compound index created by create_indexes.py; bounds both Check predicates
+CHECK_INDEX = "ts_genset"
+
 def build_optimized_query(start_datetime: datetime, end_datetime: datetime, is_check: bool) -> Dict[str, Any]:
     """Build optimized MongoDB query with proper indexing hints"""
+    # Native datetimes are sent as BSON dates, so the range is an index scan
+    # instead of a lexicographic string comparison. Requires timestamp to be
+    # stored as a date; see migrate_timestamps.py for string-typed data
     query = {
         "timestamp": {
-            "$gte": start_datetime.isoformat(), 
-            "$lte": end_datetime.isoformat()
+            "$gte": start_datetime,
+            "$lte": end_datetime
         }
     }
     
@@ -44,58 +69,285 @@ def build_optimized_query(start_datetime: datetime, end_datetime: datetime, is_c
 
 def get_projection_fields() -> Optional[Dict[str, int]]:
     """Define projection to reduce data transfer - customize based on your needs"""
-    # Return None to fetch all fields, or specify fields to reduce network transfer
-    # Example: return {"timestamp": 1, "Genset_Run_SS": 1, "field1": 1, "field2": 1}
-    return None
+    # Exclude _id so the driver never decodes ObjectIds we would only stringify
+    return {"_id": 0}
+
+def _quote(value: Any) -> str:
+    """Render one CSV field, quoting only when the value contains a delimiter"""
+    if value is None:
+        return ""
+    text = str(value)
+    if "," in text or '"' in text or "\n" in text or "\r" in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def _open_gzip(buffer: io.BytesIO) -> gzip.GzipFile:
+    """Gzip into a byte buffer; level 1 keeps CPU low while telemetry still shrinks several-fold"""
+    return gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=1)
+
+def _open_csv_writer(buffer: io.BytesIO) -> io.TextIOWrapper:
+    """Wrap a byte buffer in a gzipped UTF-8 text stream; close it to finish the gzip trailer"""
+    return io.TextIOWrapper(io.BufferedWriter(_open_gzip(buffer), buffer_size=1 << 20), encoding="utf-8", newline="")
 
-def stream_data_to_csv(collection, query: Dict[str, Any], projection: Optional[Dict[str, int]] = None) -> tuple[str, int]:
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_export_batch_size(_db, collection_name: str) -> int:
+    """Pick a cursor batch size that fills MongoDB's 16MB reply limit for the average document"""
+    try:
+        avg_obj_size = int(_db.command("collStats", collection_name).get("avgObjSize", 0))
+    except Exception:
+        avg_obj_size = 0
+    
+    if avg_obj_size <= 0:
+        return 10000
+    return max(1, min(100000, 15_000_000 // avg_obj_size))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_export_headers(_collection, query: Dict[str, Any], projection: Optional[Dict[str, int]] = None) -> List[str]:
+    """Probe the CSV columns up front so no export waits on its first row"""
+    # Union of keys, in first-seen order, over the start of the selected range
+    # plus a random sample of the collection, so sparse fields still get a column
+    pipeline = [{"$sample": {"size": 100}}]
+    if projection:
+        pipeline.append({"$project": projection})
+    
+    headers = {}
+    for doc in _collection.find(query, projection).limit(100):
+        headers.update(dict.fromkeys(doc))
+    for doc in _collection.aggregate(pipeline):
+        headers.update(dict.fromkeys(doc))
+    return list(headers)
+
+def split_time_range(query: Dict[str, Any], parts: int) -> List[Dict[str, Any]]:
+    """Split the query's timestamp window into contiguous, ordered sub-queries"""
+    start = query["timestamp"]["$gte"]
+    end = query["timestamp"]["$lte"]
+    step = (end - start) / parts
+    bounds = [start + step * i for i in range(parts)] + [end]
+    
+    sub_queries = []
+    for i in range(parts):
+        # Only the last sub-range keeps the inclusive upper bound
+        upper_op = "$lte" if i == parts - 1 else "$lt"
+        sub_queries.append({**query, "timestamp": {"$gte": bounds[i], upper_op: bounds[i + 1]}})
+    return sub_queries
+
+# Marks the end of a sub-range in its worker's queue
+_RANGE_DONE = object()
+
+def _put_until_stopped(out: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """Block on a full queue, giving up once the consumer has gone away"""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _fetch_raw_batches(collection, query: Dict[str, Any], projection: Optional[Dict[str, int]], batch_size: int, comment: str, hint: Optional[str], out: queue.Queue, stop: threading.Event) -> None:
+    """Feed one sub-range's raw BSON batches into a bounded queue; pymongo releases the GIL while waiting on the network"""
+    result = _RANGE_DONE
+    try:
+        # Sessions aren't thread-safe, so each worker binds its cursor to its own;
+        # an aborted rerun then releases the server cursor instead of leaking it
+        with collection.database.client.start_session() as session:
+            cursor = collection.find_raw_batches(
+                query,
+                projection,
+                session=session,
+                comment=comment,
+                hint=hint,
+                batch_size=batch_size
+            ).max_time_ms(EXPORT_MAX_TIME_MS)
+            try:
+                for raw_batch in cursor:
+                    if not _put_until_stopped(out, raw_batch, stop):
+                        return
+            finally:
+                cursor.close()
+    except Exception as e:
+        result = e
+    
+    _put_until_stopped(out, result, stop)
+
+def iter_document_batches(collection, query: Dict[str, Any], projection: Optional[Dict[str, int]] = None, comment: str = "navy_export", hint: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+    """Yield documents one server batch at a time, decoding each raw BSON batch in a single C call"""
+    batch_size = get_export_batch_size(collection.database, collection.name)
+    sub_queries = split_time_range(query, EXPORT_WORKERS)
+    
+    # Sub-ranges are fetched in parallel but yielded in time order; each worker
+    # only runs EXPORT_PREFETCH_BATCHES ahead, so the export is never fully buffered
+    queues = [queue.Queue(maxsize=EXPORT_PREFETCH_BATCHES) for _ in sub_queries]
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(sub_queries)) as executor:
+        for sub_query, out in zip(sub_queries, queues):
+            executor.submit(_fetch_raw_batches, collection, sub_query, projection, batch_size, comment, hint, out, stop)
+        
+        try:
+            for out in queues:
+                while True:
+                    item = out.get()
+                    if item is _RANGE_DONE:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield bson.decode_all(item, collection.codec_options)
+        finally:
+            # Unblocks workers still waiting on a full queue
+            stop.set()
+
+def stream_data_to_csv(collection, query: Dict[str, Any], headers: List[str], projection: Optional[Dict[str, int]] = None, comment: str = "navy_export", hint: Optional[str] = None) -> tuple[bytes, int]:
     """Optimized streaming data extraction with better memory management"""
-    buffer = io.StringIO()
-    writer = None
+    buffer = io.BytesIO()
+    text = _open_csv_writer(buffer)
     count = 0
-    headers_written = False
     
     try:
-        # Optimized cursor with larger batch size and projection
-        cursor = collection.find(
-            query, 
-            projection,
-            no_cursor_timeout=True
-        ).batch_size(10000)  # Increased batch size
+        # Header is written once; every batch is then serialized by pandas'
+        # vectorized CSV writer instead of a Python loop per row
+        text.write(",".join([_quote(h) for h in headers]) + "\n")
+        
+        for docs in iter_document_batches(collection, query, projection, comment, hint):
+            if not docs:
+                continue
+            
+            # dtype=object stops per-batch inference (e.g. an int column turning
+            # into 1.0 in batches with missing values); values are written via str()
+            pd.DataFrame(docs, columns=headers, dtype=object).to_csv(text, header=False, index=False, lineterminator="\n")
+            count += len(docs)
+        
+        text.close()  # leaves the BytesIO open
+        
+    except Exception as e:
+        st.error(f"Database error: {str(e)}")
+        return b"", 0
+    
+    # BytesIO hands back its own storage here, so no second copy is made
+    return buffer.getvalue(), count
+
+def fetch_data_to_csv_pandas(collection, query: Dict[str, Any], headers: List[str], projection: Optional[Dict[str, int]] = None, comment: str = "navy_export", hint: Optional[str] = None) -> tuple[bytes, int]:
+    """Load the full result into one DataFrame and serialize it with a single to_csv call"""
+    buffer = io.BytesIO()
+    text = _open_csv_writer(buffer)
+    
+    try:
+        docs = []
+        for batch in iter_document_batches(collection, query, projection, comment, hint):
+            docs.extend(batch)
         
-        # Hint to use timestamp index (adjust index name as needed)
-        cursor.hint([("timestamp", 1)])
+        if not docs:
+            return b"", 0
         
-        # Process in chunks for better memory management
-        batch = []
-        batch_size = 1000
+        # Same layout as the streaming mode, so Auto's choice never changes the file:
+        # dtype=object writes every value via str(), including mixed-type and nested
+        # fields, and quoting is only applied where a cell needs it
+        df = pd.DataFrame(docs, columns=headers, dtype=object)
+        text.write(",".join([_quote(h) for h in headers]) + "\n")
+        df.to_csv(text, header=False, index=False, lineterminator="\n")
+        text.close()  # leaves the BytesIO open
         
-        for doc in cursor:
-            doc["_id"] = str(doc["_id"])
+    except Exception as e:
+        st.error(f"Database error: {str(e)}")
+        return b"", 0
+    
+    return buffer.getvalue(), len(df)
+
+def _csv_value_expr(field: str) -> Dict[str, Any]:
+    """Aggregation expression stringifying one field the way Python's str() does client-side"""
+    value = f"${field}"
+    value_type = {"$type": value}
+    return {
+        "$switch": {
+            "branches": [
+                {
+                    # str(datetime): seconds only, or 6 fractional digits when there are milliseconds
+                    "case": {"$eq": [value_type, "date"]},
+                    "then": {
+                        "$cond": [
+                            {"$eq": [{"$millisecond": value}, 0]},
+                            {"$dateToString": {"date": value, "format": "%Y-%m-%d %H:%M:%S"}},
+                            {"$dateToString": {"date": value, "format": "%Y-%m-%d %H:%M:%S.%L000"}}
+                        ]
+                    }
+                },
+                {"case": {"$eq": [value_type, "bool"]}, "then": {"$cond": [value, "True", "False"]}},
+                {
+                    # Whole doubles keep their ".0" like str(float)
+                    "case": {"$and": [{"$eq": [value_type, "double"]}, {"$eq": [value, {"$trunc": value}]}]},
+                    "then": {"$concat": [{"$toString": value}, ".0"]}
+                }
+            ],
+            # Arrays, objects and binary can't be converted; blank them instead of failing the export
+            "default": {"$convert": {"input": value, "to": "string", "onError": "", "onNull": ""}}
+        }
+    }
+
+def _csv_field_expr(field: str) -> Dict[str, Any]:
+    """Aggregation expression rendering one field as a CSV cell, quoted the same way as _quote"""
+    return {
+        "$let": {
+            "vars": {"v": _csv_value_expr(field)},
+            "in": {
+                "$cond": [
+                    {"$regexMatch": {"input": "$$v", "regex": '[,"\r\n]'}},
+                    {"$concat": ['"', {"$replaceAll": {"input": "$$v", "find": '"', "replacement": '""'}}, '"']},
+                    "$$v"
+                ]
+            }
+        }
+    }
+
+def aggregate_data_to_csv(collection, query: Dict[str, Any], headers: List[str], comment: str = "navy_export", hint: Optional[str] = None) -> tuple[bytes, int]:
+    """Have MongoDB build each CSV line with $concat so the driver only transports strings"""
+    buffer = io.BytesIO()
+    text = _open_csv_writer(buffer)
+    count = 0
+    
+    try:
+        cells = []
+        for i, header in enumerate(headers):
+            if i:
+                cells.append(",")
+            cells.append(_csv_field_expr(header))
+        
+        pipeline = [
+            {"$match": query},
+            {"$project": {"_id": 0, "line": {"$concat": cells}}}
+        ]
+        with collection.database.client.start_session() as session:
+            cursor = collection.aggregate(
+                pipeline,
+                session=session,
+                batchSize=get_export_batch_size(collection.database, collection.name),
+                allowDiskUse=True,
+                maxTimeMS=EXPORT_MAX_TIME_MS,
+                comment=comment,
+                **({"hint": hint} if hint else {})
+            )
             
-            if not headers_written:
-                headers = list(doc.keys())
-                writer = csv.DictWriter(buffer, fieldnames=headers)
-                writer.writeheader()
-                headers_written = True
+            lines = [",".join([_quote(h) for h in headers])]
+            batch_size = 1000
             
-            batch.append(doc)
-            count += 1
+            for doc in cursor:
+                lines.append(doc["line"])
+                count += 1
+                
+                if len(lines) >= batch_size:
+                    lines.append("")
+                    text.write("\n".join(lines))
+                    lines.clear()
             
-            # Write batch when it reaches batch_size
-            if len(batch) >= batch_size:
-                writer.writerows(batch)
-                batch.clear()
-        
-        # Write remaining batch
-        if batch and writer:
-            writer.writerows(batch)
+            if lines:
+                lines.append("")
+                text.write("\n".join(lines))
+            
+            cursor.close()
         
-        cursor.close()
+        text.close()  # leaves the BytesIO open
         
     except Exception as e:
         st.error(f"Database error: {str(e)}")
-        return "", 0
+        return b"", 0
     
     return buffer.getvalue(), count
 
@@ -106,8 +358,8 @@ st.title("Date Range Filter")
 # Add performance mode selection
 performance_mode = st.selectbox(
     "Performance Mode",
-    ["Standard (Streaming)"],
-    help="Standard: Better for very large datasets. Fast: Better for medium datasets. Auto: Automatically choose based on estimated size."
+    ["Standard (Streaming)", "Fast (Pandas)", "Server (Aggregation)", "Auto"],
+    help="Standard: Better for very large datasets. Fast: Better for medium datasets. Server: MongoDB formats the CSV rows, best when this host is the bottleneck. Auto: Automatically choose based on estimated size."
 )
 
 # --- Inputs ---
@@ -151,6 +403,14 @@ if check_btn or fetch_btn:
             # Build optimized query
             query = build_optimized_query(start_datetime, end_datetime, check_btn)
             projection = get_projection_fields()
+            hint = CHECK_INDEX if check_btn else None
+            try:
+                headers = get_export_headers(collection, query, projection)
+            except Exception as e:
+                st.error(f"Database error: {str(e)}")
+                headers = []
+            # Tags the export in the profiler: db.system.profile.find({"command.comment": comment})
+            comment = f"navy_export_{'check' if check_btn else 'fetch'}"
             
             # Estimate data size for auto mode
             if performance_mode == "Auto":
@@ -161,18 +421,26 @@ if check_btn or fetch_btn:
                 use_pandas = performance_mode == "Fast (Pandas)"
             
             # Process data
-            with st.spinner(f'Processing data using {"Streaming"} mode...'):
-                csv_data, count = stream_data_to_csv(collection, query, projection)
+            use_aggregation = performance_mode == "Server (Aggregation)"
+            mode_label = "Pandas" if use_pandas else "Aggregation" if use_aggregation else "Streaming"
+            with st.spinner(f'Processing data using {mode_label} mode...'):
+                if not headers:
+                    csv_data, count = b"", 0
+                elif use_pandas:
+                    csv_data, count = fetch_data_to_csv_pandas(collection, query, headers, projection, comment, hint)
+                elif use_aggregation:
+                    csv_data, count = aggregate_data_to_csv(collection, query, headers, comment, hint)
+                else:
+                    csv_data, count = stream_data_to_csv(collection, query, headers, projection, comment, hint)
             
             if count > 0:
-                csv_bytes = csv_data.encode("utf-8")
-                filename = f"navy_data_{'Check' if check_btn else 'Fetch'}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+                filename = f"navy_data_{'Check' if check_btn else 'Fetch'}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv.gz"
 
                 st.download_button(
-                    label=f"📥 Download CSV ({count:,} records)",
-                    data=csv_bytes,
+                    label=f"📥 Download CSV.gz ({count:,} records)",
+                    data=csv_data,
                     file_name=filename,
-                    mime="text/csv"
+                    mime="application/gzip"
                 )
                 st.success(f"✅ {count:,} records processed successfully")
                     
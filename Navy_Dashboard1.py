@@ -3,33 +3,59 @@ from datetime import datetime, date, time,timedelta
 from dotenv import load_dotenv
 import os
 from pymongo import MongoClient
+from bson import ObjectId
 import pandas as pd
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 load_dotenv()
 
 # --- MongoDB connection ---
 @st.cache_resource
 def get_mongo_client():
+    """One client, and so one connection pool, shared by every session in the process"""
     mongo_uri = os.getenv("MONGO_URL")
     client = MongoClient(
         mongo_uri,
         maxPoolSize=50,
         serverSelectionTimeoutMS=3000,
-        readPreference='secondaryPreferred'
+        readPreference='nearest',
+        readConcernLevel='local',
+        compressors="zstd,snappy,zlib",
+        zlibCompressionLevel=1
     )
     return client
 
-def fetch_paginated_data(collection, query: Dict[str, Any], skip: int, limit: int):
-    cursor = collection.find(query).sort("timestamp", 1).skip(skip).limit(limit).hint([("timestamp", 1)])
-    docs = []
-    for doc in cursor:
-        doc["_id"] = str(doc["_id"])
-        docs.append(doc)
-    return docs
-
-def get_total_count(collection, query: Dict[str, Any]) -> int:
-    return collection.count_documents(query, maxTimeMS=10000)
+# Results are cached per query so reruns and page clicks don't go back to Mongo;
+# the leading underscore keeps Streamlit from hashing the collection handle
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_paginated_data(_collection, query: Dict[str, Any], anchor: Optional[Tuple[datetime, str]], skip: int, limit: int):
+    # The anchor's _id arrives as a str because Streamlit can't hash ObjectId;
+    # the ObjectId is only rebuilt here, past the cache key
+    page_query = build_page_query(query, anchor)
+    # _id is kept as the keyset tie-breaker; (timestamp, _id) is a unique order backed by ts_id
+    cursor = _collection.find(page_query).comment("navy_page").sort([("timestamp", 1), ("_id", 1)]).skip(skip).limit(limit).hint("ts_id")
+    return list(cursor)
+
+def build_page_query(query: Dict[str, Any], anchor: Optional[Tuple[datetime, str]]) -> Dict[str, Any]:
+    """Keyset pagination: start after the (timestamp, _id) of the previous page's last row"""
+    if anchor is None:
+        return query
+    last_timestamp, last_id = anchor
+    return {
+        **query,
+        # $gte keeps the index scan bounded; the $or breaks timestamp ties on _id
+        "timestamp": {**query["timestamp"], "$gte": last_timestamp},
+        "$or": [{"timestamp": {"$gt": last_timestamp}}, {"_id": {"$gt": ObjectId(last_id)}}]
+    }
+
+def should_count(query: Dict[str, Any]) -> bool:
+    """An exact count walks the whole range, so wide windows page without a total"""
+    return (query["timestamp"]["$lt"] - query["timestamp"]["$gte"]).days < 7
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_total_count(_collection, query: Dict[str, Any]) -> int:
+    # ts_genset and ts_id are both created by create_indexes.py
+    return _collection.count_documents(query, hint="ts_genset", comment="navy_count")
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="Navy_Dashboard", page_icon="⚡", layout="wide")
@@ -57,6 +83,8 @@ if "query" not in st.session_state:
     st.session_state.query = None
 if "query_executed" not in st.session_state:
     st.session_state.query_executed = False
+if "page_anchors" not in st.session_state:
+    st.session_state.page_anchors = {0: None}  # page -> (timestamp, str(_id)) of the row before it
 
 # --- Date inputs ---
 col1, col2, col3, col4 = st.columns(4)
@@ -76,33 +104,31 @@ if start_datetime >= end_datetime:
     st.error("❌ End date-time must be greater than start date-time")
     st.stop()
 
+# Native datetimes go out as BSON dates (timestamp must be stored as a date, see
+# migrate_timestamps.py); the range is built once for both queries
+time_range = {"$gte": start_datetime, "$lt": end_datetime}
+
 # --- Buttons ---
 col_a, col_b = st.columns([5, 5])
 with col_b:
     if st.button("📊 Fetch Data", width="stretch"):
-        st.session_state.query = {
-            "timestamp": {
-                "$gte": start_datetime.isoformat(),
-                "$lt": end_datetime.isoformat()
-            }
-        }
+        st.session_state.query = {"timestamp": time_range}
         st.session_state.current_page = 0
         st.session_state.query_executed = True
         st.session_state.total_records = 0  # reset count
+        st.session_state.page_anchors = {0: None}
         st.rerun()
 
 with col_a:
     if st.button("🔍 Check Data", width="stretch"):
         st.session_state.query = {
-            "timestamp": {
-                "$gte": start_datetime.isoformat(),
-                "$lt": end_datetime.isoformat()
-            },
+            "timestamp": time_range,
             "Genset_Run_SS": {"$gte": 1, "$lte": 6}
         }
         st.session_state.current_page = 0
         st.session_state.query_executed = True
         st.session_state.total_records = 0  # reset count
+        st.session_state.page_anchors = {0: None}
         st.rerun()
 
 # --- Data processing ---
@@ -112,21 +138,49 @@ if st.session_state.query_executed and st.session_state.query:
         db = client["iotdb"]
         collection = db["navy"]
 
+        count_records = should_count(st.session_state.query)
+
         # Count only once
-        if st.session_state.total_records == 0:
+        if count_records and st.session_state.total_records == 0:
             with st.spinner("Counting records..."):
                 st.session_state.total_records = get_total_count(collection, st.session_state.query)
 
         total_records = st.session_state.total_records
-        if total_records == 0:
+        if count_records and total_records == 0:
             st.warning("⚠️ No data found in the specified date range")
             st.stop()
 
-        # Pagination
-        total_pages = (total_records - 1) // 1000 + 1
         current_page = st.session_state.current_page
 
-        st.info(f"📊 Found {total_records:,} records | Page {current_page + 1} of {total_pages}")
+        # Fetch page data from the closest known anchor; sequential paging never
+        # skips, a jump only skips the pages between it and that anchor.
+        # One extra row tells us whether a next page exists without counting.
+        anchors = st.session_state.page_anchors
+        anchor_page = max(page for page in anchors if page <= current_page)
+        skip = (current_page - anchor_page) * 1000
+        with st.spinner(f"Loading page {current_page + 1}..."):
+            start_fetch = datetime.now()
+            records = fetch_paginated_data(collection, st.session_state.query, anchors[anchor_page], skip, 1001)
+            fetch_time = (datetime.now() - start_fetch).total_seconds()
+
+        has_next_page = len(records) > 1000
+        records = records[:1000]
+        if len(records) == 1000:
+            anchors[current_page + 1] = (records[-1]["timestamp"], str(records[-1]["_id"]))
+
+        # Pagination
+        if count_records:
+            total_pages = (total_records - 1) // 1000 + 1
+            has_next_page = current_page < total_pages - 1
+            st.info(f"📊 Found {total_records:,} records | Page {current_page + 1} of {total_pages}")
+        else:
+            if current_page == 0 and not records:
+                st.warning("⚠️ No data found in the specified date range")
+                st.stop()
+            total_pages = None
+            seen_records = current_page * 1000 + len(records)
+            more_label = " | Loading more…" if has_next_page else ""
+            st.info(f"📊 Found {'≥' if has_next_page else ''}{seen_records:,} records | Page {current_page + 1}{more_label}")
 
         col_prev,col_space, col_info,col_space2, col_next = st.columns([1,2, 4, 2,1])
         with col_prev:
@@ -134,11 +188,13 @@ if st.session_state.query_executed and st.session_state.query:
                 st.session_state.current_page = max(0, current_page - 1)
                 st.rerun()
         with col_info:
-            # Jump to page
+            # Jump to page; without a total, only as far as the furthest known
+            # anchor so a jump never turns into a skip over millions of documents
+            max_jump_page = total_pages if total_pages is not None else max(anchors) + 1
             target_page = st.number_input( 
                 "Go to page",
                 min_value=1, 
-                max_value=total_pages,
+                max_value=max_jump_page,
                 value=current_page + 1
             ) - 1
             if target_page != current_page:
@@ -146,20 +202,15 @@ if st.session_state.query_executed and st.session_state.query:
                 st.rerun()
             
         with col_next:
-            if st.button("Next ▶", disabled=(current_page >= total_pages - 1)):
-                st.session_state.current_page = min(total_pages - 1, current_page + 1)
+            if st.button("Next ▶", disabled=not has_next_page):
+                st.session_state.current_page = current_page + 1
                 st.rerun()
 
-        # Fetch page data
-        skip = current_page * 1000
-        with st.spinner(f"Loading page {current_page + 1}..."):
-            start_fetch = datetime.now()
-            records = fetch_paginated_data(collection, st.session_state.query, skip, 1000)
-            fetch_time = (datetime.now() - start_fetch).total_seconds()
-
         if records:
             st.success(f"✅ Loaded {len(records)} records in {fetch_time:.2f}s")
-            df = pd.DataFrame(records)
+            # Keeps every key from every record; Arrow-backed dtypes reach the frontend
+            # without re-conversion, and mixed-type columns simply stay object
+            df = pd.DataFrame(records).drop(columns="_id").convert_dtypes(dtype_backend="pyarrow")
             st.dataframe(df, width="stretch", height=600)
         else:
             st.warning("⚠️ No records found on this page")
@@ -0,0 +1,32 @@
+"""One-time setup: create the indexes the Navy dashboards rely on.
+
+Run once against the deployment before starting the dashboards:
+
+    python create_indexes.py
+"""
+from dotenv import load_dotenv
+import os
+from pymongo import MongoClient
+
+load_dotenv()
+
+
+def main():
+    client = MongoClient(os.getenv("MONGO_URL"), serverSelectionTimeoutMS=5000)
+    collection = client["iotdb"]["navy"]
+
+    # Serves the timestamp range of both Fetch and Check; Check also bounds
+    # Genset_Run_SS in the index, so only matching documents are fetched
+    name = collection.create_index([("timestamp", 1), ("Genset_Run_SS", 1)], name="ts_genset")
+    print(f"Index ready: {name}")
+
+    # Orders Navy_Dashboard1.py's pages by (timestamp, _id), the keyset its
+    # pagination anchors on, so page fetches never sort in memory
+    name = collection.create_index([("timestamp", 1), ("_id", 1)], name="ts_id")
+    print(f"Index ready: {name}")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
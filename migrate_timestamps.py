@@ -0,0 +1,41 @@
+"""One-time migration: convert string `timestamp` values to BSON dates.
+
+The dashboards query `timestamp` with native datetimes. MongoDB compares
+values of different BSON types by type bracket, so a Date bound never
+matches a string field and every query would return 0 rows on documents
+that still store `timestamp` as an isoformat() string.
+
+    python migrate_timestamps.py --dry-run   # only report the stored types
+    python migrate_timestamps.py             # convert strings in place
+"""
+from dotenv import load_dotenv
+import os
+import sys
+from pymongo import MongoClient
+
+load_dotenv()
+
+
+def main():
+    dry_run = "--dry-run" in sys.argv[1:]
+    client = MongoClient(os.getenv("MONGO_URL"), serverSelectionTimeoutMS=5000)
+    collection = client["iotdb"]["navy"]
+
+    string_count = collection.count_documents({"timestamp": {"$type": "string"}})
+    date_count = collection.count_documents({"timestamp": {"$type": "date"}})
+    print(f"timestamp stored as string: {string_count:,} | as date: {date_count:,}")
+
+    if string_count and not dry_run:
+        # Naive isoformat() strings are parsed as UTC, the same way pymongo
+        # encodes the naive datetimes the dashboards send (MongoDB 4.2+)
+        result = collection.update_many(
+            {"timestamp": {"$type": "string"}},
+            [{"$set": {"timestamp": {"$toDate": "$timestamp"}}}]
+        )
+        print(f"Converted {result.modified_count:,} documents")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()